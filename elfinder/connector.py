@@ -1,8 +1,6 @@
 from django.core.exceptions import ObjectDoesNotExist
 from elfinder.models import FileCollection, Directory, File
 import logging
-import traceback
-import sys
 
 
 """ Connector class for Django/elFinder integration.
@@ -19,10 +17,16 @@ import sys
 logger = logging.getLogger(__name__)
 
 
-class ElFinderConnector():
+class ElFinderConnector(object):
+    __slots__ = ('httpResponse', 'httpStatusCode', 'httpHeader', 'data',
+                 'response', 'return_view', 'volumes', 'request')
     _version = '2.0'
+    _allowed_http_params = frozenset(['cmd', 'target', 'targets[]', 'current',
+                                      'tree', 'name', 'content', 'src', 'dst',
+                                      'cut', 'init', 'type', 'width', 'height',
+                                      'upload[]'])
 
-    def __init__(self, volumes={}):
+    def __init__(self, volumes=None):
         self.httpResponse = {}
         self.httpStatusCode = 200
         self.httpHeader = {'Content-type': 'application/json'}
@@ -32,31 +36,30 @@ class ElFinderConnector():
 
         # Populate the volumes dict, using volume_id as the key
         self.volumes = {}
-        for volume in volumes:
+        for volume in volumes or []:
             self.volumes[volume.get_volume_id()] = volume
 
     def get_commands(self):
         """ Returns a dict which maps command names to functions.
 
             The dict key is the command name. The value is a tuple containing
-            the name of a function on this class, and a dict specifying which
-            GET variables must be set/unset. This lets us do validation of the
-            given arguments, so the command functions can assume the correct
-            values are set. Used by check_command_functions.
+            the bound method which handles the command, and a dict specifying
+            which GET variables must be set/unset. This lets us do validation
+            of the given arguments, so the command functions can assume the
+            correct values are set. Used by check_command_functions.
         """
-        return {'open': ('__open', {'target': True}),
-                'tree': ('__tree', {'target': True}),
-                'file': ('__file', {'target': True}),
-                'parents': ('__parents', {'target': True}),
-                'mkdir': ('__mkdir', {'target': True, 'name': True}),
-                'mkfile': ('__mkfile', {'target': True, 'name': True}),
-                'rename': ('__rename', {'target': True, 'name': True}),
-                'ls': ('__list', {'target': True}),
-                'paste': ('__paste', {'targets[]': True, 'src': True,
-                                      'dst': True, 'cut': True}),
-                'rename': ('__rename', {'target': True, 'name': True}),
-                'rm': ('__remove', {'targets[]': True}),
-                'upload': ('__upload', {'target': True}),
+        return {'open': (self.__open, {'target': True}),
+                'tree': (self.__tree, {'target': True}),
+                'file': (self.__file, {'target': True}),
+                'parents': (self.__parents, {'target': True}),
+                'mkdir': (self.__mkdir, {'target': True, 'name': True}),
+                'mkfile': (self.__mkfile, {'target': True, 'name': True}),
+                'rename': (self.__rename, {'target': True, 'name': True}),
+                'ls': (self.__list, {'target': True}),
+                'paste': (self.__paste, {'targets[]': True, 'src': True,
+                                         'dst': True, 'cut': True}),
+                'rm': (self.__remove, {'targets[]': True}),
+                'upload': (self.__upload, {'target': True}),
                }
 
     def get_init_params(self):
@@ -75,11 +78,9 @@ class ElFinderConnector():
                }
 
     def get_allowed_http_params(self):
-        """ Returns a list of parameters allowed during GET/POST requests.
+        """ Returns a set of parameters allowed during GET/POST requests.
         """
-        return ['cmd', 'target', 'targets[]', 'current', 'tree',
-                'name', 'content', 'src', 'dst', 'cut', 'init',
-                'type', 'width', 'height', 'upload[]']
+        return self._allowed_http_params
 
     def get_volume(self, hash):
         """ Returns the volume which contains the file/dir represented by the
@@ -99,20 +100,19 @@ class ElFinderConnector():
             This means command functions do not need to check for the presence
             of GET vars manually - they can assume that required items exist.
         """
-        for field in command_variables:
-            if command_variables[field] == True and field not in self.data:
-                return False
-            elif command_variables[field] == False and field in self.data:
+        for field, required in command_variables.iteritems():
+            # A field must be present exactly when it is required
+            if required != (field in self.data):
                 return False
         return True
 
-    def run_command(self, func_name, command_variables):
+    def run_command(self, func, command_variables):
         """ Attempts to run the given command.
 
             If the command does not execute, or there are any problems
             validating the given GET vars, an error message is set.
 
-            func: the name of the function to run (e.g. __open)
+            func: the function to run (e.g. self.__open)
             command_variables: a list of 'name':True/False tuples specifying
             which GET variables must be present or empty for this command.
         """
@@ -120,11 +120,6 @@ class ElFinderConnector():
             self.response['error'] = 'Invalid arguments'
             return
 
-        func = getattr(self, '_' + self.__class__.__name__ + func_name, None)
-        if not callable(func):
-            self.response['error'] = 'Command failed'
-            return
-
         try:
             func()
         except Exception, e:
@@ -151,9 +146,11 @@ class ElFinderConnector():
         elif request.method == 'GET':
             data_source = request.GET
 
-        # Copy allowed parameters from the given request's GET to self.data
-        for field in self.get_allowed_http_params():
-            if field in data_source:
+        # Copy allowed parameters from the given request's GET to self.data.
+        # Only the parameters which were actually sent need to be checked.
+        allowed_params = self.get_allowed_http_params()
+        for field in data_source:
+            if field in allowed_params:
                 if field == "targets[]":
                     self.data[field] = data_source.getlist(field)
                 else:
@@ -161,11 +158,10 @@ class ElFinderConnector():
 
         # If a valid command has been specified, try and run it. Otherwise set
         # the relevant error message.
-        commands = self.get_commands()
         if 'cmd' in self.data:
-            if self.data['cmd'] in commands:
-                cmd = commands[self.data['cmd']]
-                self.run_command(cmd[0], cmd[1])
+            command = self.get_commands().get(self.data['cmd'])
+            if command is not None:
+                self.run_command(*command)
             else:
                 self.response['error'] = 'Unknown command'
         else:
@@ -203,15 +199,13 @@ class ElFinderConnector():
     def __file(self):
         """ Handles the 'file' command.
 
-            Sets return_view, which will cause read_file_view to be rendered
-            as the response. A custom read_file_view can be given when
-            initialising the connector.
+            Sets return_view, which will cause the volume's read_file_view to
+            be rendered as the response.
         """
         target = self.data['target']
         volume = self.get_volume(target)
 
         # A file was requested, so set return_view to the read_file view.
-        #self.return_view = self.read_file_view(self.request, volume, target)
         self.return_view = volume.read_file_view(self.request, target)
 
     def __open(self):
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'Directory'
+        db.create_table('elfinder_directory', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('name', self.gf('django.db.models.fields.CharField')(max_length=255)),
+            ('parent', self.gf('mptt.fields.TreeForeignKey')(blank=True, related_name='dirs', null=True, to=orm['elfinder.Directory'])),
+            ('collection', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['elfinder.FileCollection'])),
+            ('lft', self.gf('django.db.models.fields.PositiveIntegerField')(db_index=True)),
+            ('rght', self.gf('django.db.models.fields.PositiveIntegerField')(db_index=True)),
+            ('tree_id', self.gf('django.db.models.fields.PositiveIntegerField')(db_index=True)),
+            ('level', self.gf('django.db.models.fields.PositiveIntegerField')(db_index=True)),
+        ))
+        db.send_create_signal('elfinder', ['Directory'])
+
+        # Adding unique constraint on 'Directory', fields ['name', 'parent']
+        db.create_unique('elfinder_directory', ['name', 'parent_id'])
+
+        # Adding model 'FileCollection'
+        db.create_table('elfinder_filecollection', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('name', self.gf('django.db.models.fields.CharField')(unique=True, max_length=255)),
+        ))
+        db.send_create_signal('elfinder', ['FileCollection'])
+
+        # Adding model 'File'
+        db.create_table('elfinder_file', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('name', self.gf('django.db.models.fields.CharField')(max_length=255)),
+            ('parent', self.gf('mptt.fields.TreeForeignKey')(blank=True, related_name='files', null=True, to=orm['elfinder.Directory'])),
+            ('content', self.gf('django.db.models.fields.TextField')(max_length=2048, blank=True)),
+            ('collection', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['elfinder.FileCollection'])),
+        ))
+        db.send_create_signal('elfinder', ['File'])
+
+        # Adding unique constraint on 'File', fields ['name', 'parent']
+        db.create_unique('elfinder_file', ['name', 'parent_id'])
+
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'File', fields ['name', 'parent']
+        db.delete_unique('elfinder_file', ['name', 'parent_id'])
+
+        # Removing unique constraint on 'Directory', fields ['name', 'parent']
+        db.delete_unique('elfinder_directory', ['name', 'parent_id'])
+
+        # Deleting model 'Directory'
+        db.delete_table('elfinder_directory')
+
+        # Deleting model 'FileCollection'
+        db.delete_table('elfinder_filecollection')
+
+        # Deleting model 'File'
+        db.delete_table('elfinder_file')
+
+
+    models = {
+        'elfinder.directory': {
+            'Meta': {'unique_together': "(('name', 'parent'),)", 'object_name': 'Directory'},
+            'collection': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['elfinder.FileCollection']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'level': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            'lft': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'parent': ('mptt.fields.TreeForeignKey', [], {'blank': 'True', 'related_name': "'dirs'", 'null': 'True', 'to': "orm['elfinder.Directory']"}),
+            'rght': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            'tree_id': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'})
+        },
+        'elfinder.file': {
+            'Meta': {'unique_together': "(('name', 'parent'),)", 'object_name': 'File'},
+            'collection': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['elfinder.FileCollection']"}),
+            'content': ('django.db.models.fields.TextField', [], {'max_length': '2048', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'parent': ('mptt.fields.TreeForeignKey', [], {'blank': 'True', 'related_name': "'files'", 'null': 'True', 'to': "orm['elfinder.Directory']"})
+        },
+        'elfinder.filecollection': {
+            'Meta': {'object_name': 'FileCollection'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'})
+        }
+    }
+
+    complete_apps = ['elfinder']
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'FileCollection.version'
+        db.add_column('elfinder_filecollection', 'version',
+                      self.gf('django.db.models.fields.PositiveIntegerField')(default=0),
+                      keep_default=False)
+
+
+    def backwards(self, orm):
+        # Deleting field 'FileCollection.version'
+        db.delete_column('elfinder_filecollection', 'version')
+
+
+    models = {
+        'elfinder.directory': {
+            'Meta': {'unique_together': "(('name', 'parent'),)", 'object_name': 'Directory'},
+            'collection': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['elfinder.FileCollection']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'level': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            'lft': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'parent': ('mptt.fields.TreeForeignKey', [], {'blank': 'True', 'related_name': "'dirs'", 'null': 'True', 'to': "orm['elfinder.Directory']"}),
+            'rght': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            'tree_id': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'})
+        },
+        'elfinder.file': {
+            'Meta': {'unique_together': "(('name', 'parent'),)", 'object_name': 'File'},
+            'collection': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['elfinder.FileCollection']"}),
+            'content': ('django.db.models.fields.TextField', [], {'max_length': '2048', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'parent': ('mptt.fields.TreeForeignKey', [], {'blank': 'True', 'related_name': "'files'", 'null': 'True', 'to': "orm['elfinder.Directory']"})
+        },
+        'elfinder.filecollection': {
+            'Meta': {'object_name': 'FileCollection'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'}),
+            'version': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'})
+        }
+    }
+
+    complete_apps = ['elfinder']
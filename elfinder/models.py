@@ -1,20 +1,43 @@
 from django.db import models
+from django.db.models import F
 from django.dispatch import receiver
-from django.db.models.signals import pre_delete
+from django.utils.functional import cached_property
+from django.db.models.signals import pre_delete, post_save, post_delete
 from mptt.models import MPTTModel, TreeForeignKey
+from contextlib import contextmanager
+import threading
+
+
+# Ids of FileCollections whose version is due to be incremented, while
+# version updates are deferred (see defer_version_updates)
+_deferred_versions = threading.local()
+
+
+def make_hash(volume_id, type, id):
+    """ Returns the hash of the object with the given type letter ('d' for a
+        Directory, 'f' for a File) and id, or '' if id is None (the parent of
+        a root dir). See ModelVolumeDriver.get_object.
+    """
+    if id is None:
+        return ''
+    return '%s_%s%s' % (volume_id, type, id)
 
 
 class FileCollectionChildMixin:
     """ Provides common methods for Files/Directories.
     """
-    def get_parent_hash(self):
+    def get_parent_hash(self, volume_id=None):
         """ Returns the hash of this object's parent, or '' if this is the
             root of the tree.
+
+            The parent always belongs to the same FileCollection, so the hash
+            is built from parent_id rather than fetching the parent itself.
         """
-        if self.parent:
-            return self.parent.get_hash()
-        else:
+        if self.parent_id is None:
             return ''
+        if volume_id is None:
+            volume_id = self.collection.volume_id
+        return make_hash(volume_id, 'd', self.parent_id)
 
 
 class Directory(MPTTModel, FileCollectionChildMixin):
@@ -32,33 +55,80 @@ class Directory(MPTTModel, FileCollectionChildMixin):
         verbose_name_plural = 'directories'
         unique_together = ('name', 'parent')
 
+    # The values needed by info_from_row(). ModelVolumeDriver uses these
+    # hooks if a directory model has them, so they must include the MPTT
+    # id, parent_id, lft and rght values.
+    info_fields = ('id', 'name', 'parent_id', 'lft', 'rght',
+                   'collection__name')
+
     def __unicode__(self):
         return self.name
 
-    def get_hash(self):
-        return '%s_d%s' % (self.collection.get_volume_id(), self.id)
+    def delete(self, *args, **kwargs):
+        """ Deletes the directory, with its subdirectories and files.
+            post_delete is sent for each of these, and the collection's
+            version is incremented once for all of them.
+        """
+        with defer_version_updates():
+            super(Directory, self).delete(*args, **kwargs)
+
+    def get_hash(self, volume_id=None):
+        if volume_id is None:
+            volume_id = self.collection.volume_id
+        return make_hash(volume_id, 'd', self.id)
 
-    def get_info(self):
+    def get_info(self, volume_id=None):
         """ Returns an object to represent this object in elFinder. Populates
             'cwd' in response to 'open' command.
 
             If the object is the root dir, 'volume_id' is included in the
             response.
+
+            'dirs' is worked out from the MPTT lft/rght values, so no query is
+            needed to find out if this directory has subdirectories (a leaf
+            node has rght == lft + 1).
+
+            volume_id can be given when building info for many objects in the
+            same collection, so the collection is only used for the root dir.
+
+            The object is built by info_from_row(), from the same values a
+            values() query would return.
+        """
+        if volume_id is None:
+            volume_id = self.collection.volume_id
+        parent_id = self.parent_id
+
+        row = {'id': self.id,
+               'name': self.name,
+               'parent_id': parent_id,
+               'lft': self.lft,
+               'rght': self.rght,
+               # Only shown for the root dir, so only looked up for it
+               'collection__name': (self.collection.name
+                                    if parent_id is None else None)}
+        return self.info_from_row(row, volume_id)
+
+    @classmethod
+    def info_from_row(cls, row, volume_id):
+        """ Returns the object described by get_info(), built from a dict of
+            the values named in info_fields.
         """
-        obj = {'name': self.name,
-               'hash': self.get_hash(),
-               'phash': self.get_parent_hash(),
+        parent_id = row['parent_id']
+
+        obj = {'name': row['name'],
+               'hash': make_hash(volume_id, 'd', row['id']),
+               'phash': make_hash(volume_id, 'd', parent_id),
                'mime': 'directory',
                'read': 1,
                'write': 1,
                'size': 0,
-               'dirs': 0 if (self.dirs.count() == 0) else 1
+               'dirs': 1 if row['rght'] - row['lft'] > 1 else 0
                }
 
-        if not self.parent:
-            obj['volume_id'] = self.collection.get_volume_id()
+        if parent_id is None:
+            obj['volume_id'] = volume_id
             obj['locked'] = 1
-            obj['name'] = self.collection.name
+            obj['name'] = row['collection__name']
 
         return obj
 
@@ -69,16 +139,39 @@ class FileCollection(models.Model):
         # TODO delete files/dirs when deleting file collection
     """
     name = models.CharField(max_length=255, unique=True)
+    # Incremented whenever the collection, or a File or Directory in it,
+    # changes. Used to build ETags and cache keys for connector responses.
+    version = models.PositiveIntegerField(default=0, editable=False)
     #tree_id = models.CharField(
     #root_node = models.OneToOneField(Directory)
 
     def save(self, *args, **kwargs):
         """ Creates a Directory (root node) when the FileCollection is first
             created.
+
+            The version is only changed with UPDATE queries, so the value in
+            memory may be out of date. When an existing collection is saved,
+            the stored version is incremented instead of being overwritten
+            (its name is shown as the name of the root dir), and the new
+            value is read back.
         """
         created = (self.id is None)
-        super(FileCollection, self).save(*args, **kwargs)
         if created:
+            super(FileCollection, self).save(*args, **kwargs)
+        else:
+            version = self.version
+            self.version = F('version') + 1
+            try:
+                super(FileCollection, self).save(*args, **kwargs)
+            except:
+                self.version = version
+                raise
+            self.version = type(self).objects.values_list(
+                'version', flat=True).get(pk=self.id)
+
+        if created:
+            # Discard any volume_id cached before the collection had an id
+            self.__dict__.pop('volume_id', None)
             root_dir = Directory(name='root_node_%s' % self.id,
                                  collection=self)
             root_dir.save()
@@ -86,9 +179,23 @@ class FileCollection(models.Model):
     def __unicode__(self):
         return self.name
 
-    def get_volume_id(self):
+    @cached_property
+    def volume_id(self):
+        """ The volume ID used as a prefix for hashes of objects in this
+            collection. Cached, as it is needed for every hash.
+        """
         return 'fc%s' % self.id
 
+    def get_volume_id(self):
+        return self.volume_id
+
+    @classmethod
+    def increment_version(cls, collection_id):
+        """ Increments the version of the FileCollection with the given id,
+            without loading it.
+        """
+        cls.objects.filter(pk=collection_id).update(version=F('version') + 1)
+
 
 class File(models.Model, FileCollectionChildMixin):
     """ A File in a FileCollection.
@@ -102,21 +209,87 @@ class File(models.Model, FileCollectionChildMixin):
     class Meta:
         unique_together = ('name', 'parent')
 
+    # The values needed by info_from_row()
+    info_fields = ('id', 'name', 'parent_id', 'content')
+
     def __unicode__(self):
         return self.name
 
-    def get_hash(self):
-        return '%s_f%s' % (self.collection.get_volume_id(), self.id)
+    def get_hash(self, volume_id=None):
+        if volume_id is None:
+            volume_id = self.collection.volume_id
+        return make_hash(volume_id, 'f', self.id)
 
-    def get_info(self):
+    def get_info(self, volume_id=None):
         """ Returns an object to represent this object in elFinder. Populates
             'cwd' in response to 'open' command.
+
+            The object is built by info_from_row(), from the same values a
+            values() query would return.
+        """
+        if volume_id is None:
+            volume_id = self.collection.volume_id
+        return self.info_from_row({'id': self.id,
+                                   'name': self.name,
+                                   'parent_id': self.parent_id,
+                                   'content': self.content}, volume_id)
+
+    @classmethod
+    def info_from_row(cls, row, volume_id):
+        """ Returns the object described by get_info(), built from a dict of
+            the values named in info_fields.
         """
-        return {'name': self.name,
-                'hash': self.get_hash(),
-                'phash': self.get_parent_hash(),
+        return {'name': row['name'],
+                'hash': make_hash(volume_id, 'f', row['id']),
+                'phash': make_hash(volume_id, 'd', row['parent_id']),
                 'mime': 'text/plain',
-                'size': len(self.content),
+                'size': len(row['content']),
                 'read': True,
                 'write': True,
                 'rm': True}
+
+    @classmethod
+    def bulk_get_info(cls, queryset, volume_id):
+        """ Returns a list of get_info() objects for every File in the
+            queryset, fetched with a single values() query.
+        """
+        return [cls.info_from_row(row, volume_id)
+                for row in queryset.values(*cls.info_fields)]
+
+
+@receiver(post_save, sender=Directory)
+@receiver(post_delete, sender=Directory)
+@receiver(post_save, sender=File)
+@receiver(post_delete, sender=File)
+def update_collection_version(sender, instance, **kwargs):
+    """ Increments the version of the FileCollection which the saved or
+        deleted File/Directory belongs to, or records it to be incremented
+        when version updates are deferred.
+    """
+    pending = getattr(_deferred_versions, 'pending', None)
+    if pending is None:
+        FileCollection.increment_version(instance.collection_id)
+    else:
+        pending.add(instance.collection_id)
+
+
+@contextmanager
+def defer_version_updates():
+    """ Increments the version of each FileCollection changed inside the
+        with block once, when the block is left, rather than once for every
+        File/Directory saved or deleted. Nested blocks are part of the
+        outermost one.
+    """
+    if getattr(_deferred_versions, 'pending', None) is not None:
+        yield
+        return
+
+    _deferred_versions.pending = pending = set()
+    try:
+        yield
+    finally:
+        del _deferred_versions.pending
+        # Objects saved before an error are not rolled back, so versions are
+        # still incremented
+        for collection_id in pending:
+            FileCollection.increment_version(collection_id)
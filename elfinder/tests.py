@@ -1,5 +1,10 @@
+from django.conf import settings
+from django.core.cache import cache
 from django.test import TestCase
 from django.core.urlresolvers import reverse
+from django.db import IntegrityError
+from django.test.client import RequestFactory
+from elfinder.connector import ElFinderConnector
 from elfinder.models import FileCollection, Directory, File
 from elfinder.volume_drivers.model_driver import ModelVolumeDriver
 import tempfile
@@ -36,6 +41,20 @@ class elFinderFileCollectionTest(TestCase):
         # Disable logging when running tests
         logging.disable(logging.CRITICAL)
 
+    def test_save_increments_version(self):
+        """ Ensures saving a collection increments its version, rather than
+            writing back a version which is out of date.
+        """
+        collection = FileCollection.objects.create(name='test')
+        version = FileCollection.objects.get(pk=collection.id).version
+        volume = ModelVolumeDriver(collection.id)
+        volume.mkdir('new dir', '')
+        collection.name = 'renamed'
+        collection.save()
+        self.assertEqual(collection.version, version + 2)
+        self.assertEqual(FileCollection.objects.get(pk=collection.id).version,
+                         version + 2)
+
     def test_new_filecollection(self):
         new_coll = FileCollection(name='test')
         new_coll.save()
@@ -57,9 +76,24 @@ class elFinderCmdTest(TestCase):
     def setUp(self):
         # Disable logging when running tests
         logging.disable(logging.CRITICAL)
+        # Collection versions start again for each test, so cached responses
+        # from earlier tests must not be used.
+        cache.clear()
         self.collection = FileCollection.objects.get(pk=1)
         self.volume = ModelVolumeDriver(1)
 
+    def assertValidTree(self):
+        """ Checks the MPTT values of the collection's directories have no
+            gaps or overlaps, and each directory is inside its parent.
+        """
+        dirs = Directory.objects.filter(collection=self.collection)
+        values = sorted([d.lft for d in dirs] + [d.rght for d in dirs])
+        self.assertEqual(values, range(1, len(values) + 1))
+        for dir in dirs:
+            if dir.parent_id is not None:
+                parent = Directory.objects.get(pk=dir.parent_id)
+                self.assertTrue(parent.lft < dir.lft < dir.rght < parent.rght)
+
     def get_command_response(self, variables={}):
         """ Helper function to issue commands to the connector.
         """
@@ -85,6 +119,133 @@ class elFinderCmdTest(TestCase):
         return response
 
 
+class elFinderConnectorTest(elFinderCmdTest):
+    def test_subclass_commands(self):
+        """ Ensures commands still run when the connector is subclassed.
+        """
+        class CustomConnector(ElFinderConnector):
+            pass
+
+        request = RequestFactory().get('/', {'cmd': 'open', 'target': ''})
+        finder = CustomConnector([self.volume])
+        finder.run(request)
+        self.assertFalse('error' in finder.httpResponse)
+        self.assertEqual(finder.httpResponse['cwd']['name'], 'Books')
+
+
+class elFinderConditionalTest(elFinderCmdTest):
+    """ Tests ETag handling for connector requests.
+    """
+    def setUp(self):
+        super(elFinderConditionalTest, self).setUp()
+        self.url = reverse('elfinder_connector', args=[self.collection.id])
+
+    def test_not_modified(self):
+        vars = {'cmd': 'open',
+                'target': 'fc1_d2'}
+        response = self.client.get(self.url, vars)
+        etag = response['ETag']
+        response = self.client.get(self.url, vars, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_modified_after_write(self):
+        vars = {'cmd': 'open',
+                'target': 'fc1_d2'}
+        etag = self.client.get(self.url, vars)['ETag']
+        self.volume.mkdir('new dir', 'fc1_d2')
+        response = self.client.get(self.url, vars, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_no_etag_for_errors(self):
+        """ Ensures error responses are not given an ETag, so they are not
+            revalidated while the collection is unchanged.
+        """
+        vars = {'cmd': 'open',
+                'target': 'fc1_d999'}
+        response = self.client.get(self.url, vars)
+        self.assertTrue('error' in json.loads(response.content))
+        self.assertFalse(response.has_header('ETag'))
+
+    def test_conditional_get_middleware(self):
+        """ Ensures the response body survives middleware which reads the
+            content to set Content-Length.
+        """
+        middleware = settings.MIDDLEWARE_CLASSES + (
+            'django.middleware.http.ConditionalGetMiddleware',)
+        with self.settings(MIDDLEWARE_CLASSES=middleware):
+            response = self.client.get(self.url, {'cmd': 'mkdir',
+                                                  'target': 'fc1_d2',
+                                                  'name': 'new dir'})
+        self.assertEqual(int(response['Content-Length']),
+                         len(response.content))
+        self.assertEqual(json.loads(response.content)['added'][0]['name'],
+                         'new dir')
+
+    def test_collection_fetched_once(self):
+        """ Ensures the ETag and the connector share one collection query.
+            The other queries fetch the target, its subdirectories and its
+            files.
+        """
+        vars = {'cmd': 'open',
+                'target': 'fc1_d2'}
+        with self.assertNumQueries(4):
+            self.client.get(self.url, vars)
+
+    def test_cached_response(self):
+        """ Ensures responses to read-only commands are cached until the
+            collection changes.
+        """
+        vars = {'cmd': 'open',
+                'target': 'fc1_d2'}
+        response = self.get_json_response(vars)
+        with self.assertNumQueries(1):
+            cached_response = self.get_json_response(vars)
+        self.assertEqual(cached_response.json, response.json)
+
+        self.volume.mkdir('new dir', 'fc1_d2')
+        response = self.get_json_response(vars)
+        self.assertEqual(len(response.json['files']),
+                         len(cached_response.json['files']) + 1)
+
+    def test_cache_ignores_other_params(self):
+        """ Ensures parameters which the connector does not read, such as
+            the client's cache buster and the CSRF token, do not stop
+            responses from being cached.
+        """
+        vars = {'cmd': 'open',
+                'target': 'fc1_d2'}
+        etag = self.client.get(self.url, dict(vars, _='1'))['ETag']
+        response = self.client.get(self.url, dict(vars, _='2'),
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.get_json_response(dict(vars, csrfmiddlewaretoken='a'))
+        with self.assertNumQueries(1):
+            self.get_json_response(dict(vars, csrfmiddlewaretoken='b'))
+
+    def test_collection_rename_invalidates_cache(self):
+        """ Ensures a cached response is not used once the collection has
+            been renamed, as the root dir's name is the collection's name.
+        """
+        vars = {'cmd': 'open',
+                'target': ''}
+        self.get_json_response(vars)
+        self.collection.name = 'Renamed'
+        self.collection.save()
+        response = self.get_json_response(vars)
+        self.assertEqual(response.json['cwd']['name'], 'Renamed')
+
+    def test_no_etag_for_writes(self):
+        response = self.client.get(self.url, {'cmd': 'mkdir',
+                                              'target': 'fc1_d2',
+                                              'name': 'new dir'})
+        self.assertFalse(response.has_header('ETag'))
+        response = self.get_command_response({'cmd': 'open',
+                                              'target': 'fc1_d2'})
+        self.assertFalse(response.has_header('ETag'))
+
+
 class elFinderInvalidCmds(elFinderCmdTest):
     def test_unknown_cmd(self):
         response = self.get_json_response({'cmd': 'invalid_cmd_test'}, False)
@@ -139,6 +300,19 @@ class elFinderMkdirCmd(elFinderCmdTest):
                  'name': 'new dir'})
         response = self.get_json_response(vars)
 
+    def test_mkdir_sets_parent_dirs(self):
+        """ Ensures 'dirs' is set on a directory once a subdirectory has been
+            created in it.
+        """
+        self.assertEqual(self.volume.get_info('fc1_d4')['dirs'], 0)
+        vars = ({'cmd': 'mkdir',
+                 'target': 'fc1_d4',
+                 'name': 'new dir'})
+        response = self.get_json_response(vars)
+        self.assertEqual(response.json['added'][0]['dirs'], 0)
+        volume = ModelVolumeDriver(1)
+        self.assertEqual(volume.get_info('fc1_d4')['dirs'], 1)
+
     def test_invalid_target(self):
         response = self.get_json_response({'cmd': 'mkdir',
                                            'target': 'does-not-exist',
@@ -159,6 +333,16 @@ class elFinderMkdirCmd(elFinderCmdTest):
                          'Directory with this Name and Parent already exists.')
 
 
+    def test_duplicate_dir_leaves_tree(self):
+        """ Ensures a failed mkdir does not leave space in the tree for the
+            directory.
+        """
+        self.volume.mkdir('new dir', 'fc1_d4')
+        self.assertRaises(Exception, ModelVolumeDriver(1).mkdir, 'new dir',
+                          'fc1_d4')
+        self.assertValidTree()
+
+
 class elFinderMkfileCmd(elFinderCmdTest):
     def test_invalid_args(self):
         vars = ({'cmd': 'mkdir'})
@@ -189,6 +373,25 @@ class elFinderParentsCmd(elFinderCmdTest):
                 'target': 'fc1_d1'}
         response = self.get_json_response(vars)
 
+    def test_ancestor_siblings(self):
+        """ Ensures the siblings of every ancestor are included in the tree,
+            but not the siblings of the root node.
+        """
+        vars = {'cmd': 'parents',
+                'target': 'fc1_d4'}
+        response = self.get_json_response(vars)
+        hashes = set([item['hash'] for item in response.json['tree']])
+        self.assertEqual(hashes, set(['fc1_d1', 'fc1_d2', 'fc1_d3',
+                                      'fc1_d4', 'fc1_d5',
+                                      'fc1_f2', 'fc1_f3']))
+
+    def test_no_duplicates(self):
+        vars = {'cmd': 'parents',
+                'target': 'fc1_d4'}
+        response = self.get_json_response(vars)
+        hashes = [item['hash'] for item in response.json['tree']]
+        self.assertEqual(len(hashes), len(set(hashes)))
+
 
 class elFinderTreeCmd(elFinderCmdTest):
     def test_valid_tree(self):
@@ -206,6 +409,28 @@ class elFinderRenameCmd(elFinderCmdTest):
         self.assertEqual(response.json['added'][0]['name'], 'new_name.html')
         self.assertEqual(response.json['removed'], ['fc1_f1'])
 
+    def test_duplicate_name(self):
+        vars = {'cmd': 'rename',
+                'target': 'fc1_d4',
+                'name': 'Doyle, Arthur Conan'}
+        response = self.get_json_response(vars, fail_on_error=False)
+        self.assertEqual(response.json['error'],
+                         'Directory with this Name and Parent already exists.')
+
+    def test_invalid_target(self):
+        vars = {'cmd': 'rename',
+                'target': 'fc1_f1234',
+                'name': 'new_name.html'}
+        response = self.get_json_response(vars, fail_on_error=False)
+        self.assertEqual(response.json['error'], 'Could not open target')
+
+    def test_rename_updates_version(self):
+        """ Ensures renaming changes the collection's version.
+        """
+        self.volume.rename('new_name.html', 'fc1_f1')
+        self.assertEqual(FileCollection.objects.get(pk=1).version,
+                         self.collection.version + 1)
+
     def test_missing_name(self):
         vars = {'cmd': 'rename',
                 'target': 'fc1_f1'}
@@ -219,6 +444,13 @@ class elFinderListCmd(elFinderCmdTest):
         response = self.get_json_response(vars)
         self.assertEqual(len(response.json['list']), 2)
 
+    def test_dir_with_files(self):
+        vars = {'cmd': 'ls',
+                'target': 'fc1_d4'}
+        response = self.get_json_response(vars)
+        self.assertEqual(sorted(response.json['list']),
+                         ['A Christmas Carol', 'A Tale of Two Cities'])
+
     def test_invalid_dir(self):
         vars = {'cmd': 'ls',
                 'target': 'fc1_d1234'}
@@ -236,6 +468,62 @@ class elFinderPasteCmd(elFinderCmdTest):
         self.assertEqual(len(response.json['added']), 1)
         self.assertEqual(response.json['removed'], ['fc1_f1'])
 
+    def test_move_replaces_existing(self):
+        """ Ensures an object with the same name in the destination is
+            replaced.
+        """
+        existing = self.volume.mkfile('The Adventures of Sherlock Holmes',
+                                      'fc1_d3')
+        vars = {'cmd': 'paste',
+                'targets[]': ['fc1_f1'],
+                'src': 'fc1_d5',
+                'dst': 'fc1_d3',
+                'cut': '1'}
+        response = self.get_json_response(vars)
+        self.assertEqual(response.json['removed'],
+                         [existing['hash'], 'fc1_f1'])
+        self.assertEqual(list(File.objects.filter(parent=3)),
+                         [File.objects.get(pk=1)])
+
+    def test_move_replaces_several_dirs(self):
+        """ Ensures the tree stays valid when several directories in the
+            destination are replaced by one paste.
+        """
+        files = [self.volume.mkfile('Dickens, Charles', 'fc1_d3')['hash'],
+                 self.volume.mkfile('Doyle, Arthur Conan', 'fc1_d3')['hash']]
+        vars = {'cmd': 'paste',
+                'targets[]': files,
+                'src': 'fc1_d3',
+                'dst': 'fc1_d2',
+                'cut': '1'}
+        response = self.get_json_response(vars)
+        self.assertEqual(sorted(response.json['removed']),
+                         sorted(['fc1_d4', files[0], 'fc1_d5', files[1]]))
+
+        self.assertValidTree()
+
+    def test_move_dirs_over_dirs(self):
+        """ Ensures the tree stays valid when directories replace
+            directories with subdirectories of their own.
+        """
+        for name in ['Dickens, Charles', 'Doyle, Arthur Conan']:
+            hash = self.volume.mkdir(name, 'fc1_d3')['hash']
+            self.volume.mkdir('sub dir', hash)
+        self.volume.paste(['fc1_d4', 'fc1_d5'], 'fc1_d2', 'fc1_d3', True)
+
+        self.assertValidTree()
+        self.assertEqual(list(Directory.objects.filter(parent=3).order_by(
+                                  'lft').values_list('id', flat=True)),
+                         [6, 4, 5])
+
+    def test_paste_updates_version_once(self):
+        """ Ensures the driver increments the collection's version once
+            for a paste, however many targets are pasted.
+        """
+        self.volume.paste(['fc1_f2', 'fc1_f3'], 'fc1_d4', 'fc1_d3', True)
+        self.assertEqual(FileCollection.objects.get(pk=1).version,
+                         self.collection.version + 1)
+
     def test_invalid_move(self):
         vars = {'cmd': 'paste',
                 'targets[]': ['fc1_f1234'],
@@ -272,6 +560,16 @@ class elFinderRemoveCmd(elFinderCmdTest):
         removed = response.json['removed']
         self.assertEqual(removed, ['fc1_f1'])
 
+    def test_remove_updates_version_once(self):
+        """ Ensures the collection's version is only incremented once when
+            a directory is removed with its subdirectories and files.
+        """
+        vars = {'cmd': 'rm',
+                'targets[]': ['fc1_d2', 'fc1_f4']}
+        self.get_json_response(vars)
+        self.assertEqual(FileCollection.objects.get(pk=1).version,
+                         self.collection.version + 1)
+
     def test_invalid_remove(self):
         vars = {'cmd': 'rm',
                 'targets[]': ['fc1_f1234']}
@@ -329,6 +627,29 @@ class elFinderFileCmd(elFinderCmdTest):
         self.assertTemplateUsed(response, 'read_file.html')
         self.assertEqual(response.context['file'], self.file)
 
+    def test_no_context_processors(self):
+        """ Ensures context processors are not run to display a file.
+        """
+        response = self.get_command_response({'cmd': 'file',
+                                              'target': 'fc1_f1'})
+        self.assertRaises(KeyError, lambda: response.context['user'])
+
+    def test_template_dirs_override(self):
+        """ Ensures read_file.html is looked up with the current template
+            settings, so it can be overridden.
+        """
+        template_dir = tempfile.mkdtemp()
+        try:
+            with open('%s/read_file.html' % template_dir, 'w') as template:
+                template.write('Overridden: {{ file.name }}')
+            with self.settings(TEMPLATE_DIRS=(template_dir,)):
+                response = self.get_command_response({'cmd': 'file',
+                                                      'target': 'fc1_f1'})
+        finally:
+            shutil.rmtree(template_dir)
+        self.assertEqual(response.content,
+                         'Overridden: %s' % self.file.name)
+
     def test_invalid_file(self):
         vars = ({'cmd': 'file',
                  'target': 'fc1_f1234'})
@@ -336,9 +657,151 @@ class elFinderFileCmd(elFinderCmdTest):
         self.assertEqual(response.json['error'], 'Could not open target')
 
     def test_invalid_targets(self):
-        for target in ['bad-target', 'fc1_bad', 'fc1_', 'fc1_x1']:
+        for target in ['bad-target', 'fc1_bad', 'fc1_', 'fc1_x1', 'fc1_f',
+                       'fc1_f1x']:
             vars = {'cmd': 'file',
                     'target': target}
             response = self.get_json_response(vars, fail_on_error=False)
             expected_error = 'Invalid target hash: '
             self.assertTrue(response.json['error'].startswith(expected_error))
+
+
+class elFinderModelVolumeDriverTest(elFinderCmdTest):
+    def test_get_object_cached(self):
+        """ Ensures a target is only fetched once per driver, and is fetched
+            again after a write.
+        """
+        directory = self.volume.get_object('fc1_d2')
+        self.assertNumQueries(0, self.volume.get_object, 'fc1_d2')
+        self.assertEqual(self.volume.get_object('fc1_d2'), directory)
+        self.volume.mkdir('new dir', 'fc1_d2')
+        self.assertNumQueries(1, self.volume.get_object, 'fc1_d2')
+
+    def test_other_integrity_errors_raised(self):
+        """ Ensures only name clashes are reported as duplicates.
+        """
+        new_file = File(name=None, parent_id=4, collection_id=1)
+        self.assertRaises(IntegrityError, self.volume._save_unique, new_file)
+
+    def test_get_info_cached(self):
+        """ Ensures info for a target is only built once per driver, and is
+            built again after a write.
+        """
+        info = self.volume.get_info('fc1_d2')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.volume.get_info('fc1_d2'), info)
+        self.volume.rename('renamed', 'fc1_d2')
+        self.assertEqual(self.volume.get_info('fc1_d2')['name'], 'renamed')
+
+    def test_invalid_object_ids(self):
+        for target in ['fc1_d-1', 'fc1_d+1', 'fc1_d 1', 'fc1_d1 ']:
+            self.assertRaisesRegexp(Exception, '^Invalid target hash: ',
+                                    self.volume.get_object, target)
+
+    def test_root_cached_by_hash(self):
+        """ Ensures the root directory is only fetched once, whether it is
+            requested by '' or by its hash.
+        """
+        root = self.volume.get_object('')
+        self.assertNumQueries(0, self.volume.get_object, 'fc1_d1')
+        self.assertEqual(self.volume.get_object('fc1_d1'), root)
+
+    def test_root_refetched_after_write(self):
+        """ Ensures the cached root directory is dropped after a write, as
+            its MPTT values may have changed.
+        """
+        root = self.volume.get_object('')
+        self.volume.mkdir('new dir', '')
+        with self.assertNumQueries(1):
+            new_root = self.volume.get_object('')
+        self.assertFalse(new_root is root)
+        self.assertEqual(new_root.rght, Directory.objects.get(pk=1).rght)
+
+    def test_collection_loaded_lazily(self):
+        """ Ensures the FileCollection is only loaded when it is needed.
+        """
+        volume = ModelVolumeDriver(1)
+        with self.assertNumQueries(0):
+            self.assertEqual(volume.get_volume_id(), 'fc1')
+        with self.assertNumQueries(1):
+            self.assertEqual(volume.collection, self.collection)
+
+    def test_writes_do_not_load_collection(self):
+        """ Ensures new objects are created without loading the
+            FileCollection.
+        """
+        volume = ModelVolumeDriver(1)
+        volume.mkdir('new dir', 'fc1_d2')
+        volume.mkfile('new file', 'fc1_d2')
+        self.assertFalse('collection' in volume.__dict__)
+
+    def test_tree_queries(self):
+        """ Ensures the number of queries needed to build a tree does not
+            depend on the depth of the target. The queries fetch the target,
+            its files and its ancestors with their siblings. The target has no
+            subdirectories, so they are not queried for.
+        """
+        with self.assertNumQueries(3):
+            self.volume.get_tree('fc1_d4', ancestors=True, siblings=True)
+
+    def test_tree_directories_fetched_together(self):
+        """ Ensures a target's subdirectories are fetched in the same query
+            as its ancestors and siblings.
+        """
+        for ancestors, siblings in [(True, True), (True, False),
+                                    (False, True)]:
+            volume = ModelVolumeDriver(1)
+            with self.assertNumQueries(3):
+                volume.get_tree('fc1_d2', ancestors, siblings)
+
+    def test_tree_without_row_hooks(self):
+        """ Ensures models without info_fields, info_from_row() and
+            bulk_get_info() still build the same trees, from get_info().
+        """
+        volume = ModelVolumeDriver(
+            1,
+            directory_model=type('PlainDirectory', (object,),
+                                 {'objects': Directory.objects}),
+            file_model=type('PlainFile', (object,), {'objects': File.objects}))
+        for target in ['fc1_d1', 'fc1_d2', 'fc1_d4']:
+            for ancestors, siblings in [(False, False), (True, True),
+                                        (True, False), (False, True)]:
+                self.assertEqual(volume.get_tree(target, ancestors, siblings),
+                                 self.volume.get_tree(target, ancestors,
+                                                      siblings))
+
+    def test_sibling_queries_independent_of_depth(self):
+        """ Ensures the siblings of all ancestors are fetched together,
+            however deep the target is.
+        """
+        target = 'fc1_d4'
+        for depth in range(4):
+            self.volume.mkdir('sibling', target)
+            target = self.volume.mkdir('dir', target)['hash']
+        volume = ModelVolumeDriver(1)
+        with self.assertNumQueries(3):
+            tree = volume.get_tree(target, ancestors=True, siblings=True)
+        self.assertEqual(len([info for info in tree
+                              if info['name'] == 'sibling']), 4)
+
+    def test_dirs_flag_without_queries(self):
+        """ Ensures working out whether a directory has subdirectories does
+            not need a query.
+        """
+        parent = Directory.objects.get(pk=2)
+        leaf = Directory.objects.get(pk=4)
+        with self.assertNumQueries(0):
+            self.assertEqual(parent.get_info('fc1')['dirs'], 1)
+            self.assertEqual(leaf.get_info('fc1')['dirs'], 0)
+
+    def test_bulk_get_info(self):
+        """ Ensures info built from values() rows matches get_info().
+        """
+        files = File.objects.filter(collection=1).order_by('id')
+        self.assertEqual(File.bulk_get_info(files, 'fc1'),
+                         [file.get_info('fc1') for file in files])
+
+        dirs = Directory.objects.filter(collection=1).order_by('id')
+        self.assertEqual([Directory.info_from_row(row, 'fc1') for row in
+                          dirs.values(*Directory.info_fields)],
+                         [dir.get_info('fc1') for dir in dirs])
@@ -1,11 +1,27 @@
+from django.core.cache import cache
 from django.views.generic import TemplateView
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified
 from django.shortcuts import render_to_response
-from django.utils import simplejson as json
 from django.template import RequestContext
+from django.utils.http import parse_etags, quote_etag
 from elfinder.connector import ElFinderConnector
-from elfinder.models import FileCollection
+from elfinder.models import FileCollection, defer_version_updates
 from elfinder.volume_drivers.model_driver import ModelVolumeDriver
+import hashlib
+
+# Connector commands which do not modify the FileCollection. Responses to
+# these can be cached, see get_request_digest.
+READ_COMMANDS = ('open', 'tree', 'parents', 'ls')
+
+# Number of seconds responses to READ_COMMANDS are cached for
+CACHE_TIMEOUT = 300
+
+# ujson is much faster at encoding the large lists of dicts built for 'open'
+# and 'tree' responses, so use it when it is installed.
+try:
+    import ujson as json
+except ImportError:
+    from django.utils import simplejson as json
 
 
 def index(request, coll_id):
@@ -18,27 +34,106 @@ def index(request, coll_id):
                               RequestContext(request))
 
 
+def get_collection(request, coll_id):
+    """ Returns the FileCollection with the given id.
+
+        The collection is stored on the request, so get_request_digest and
+        connector_view share one query.
+    """
+    if getattr(request, '_elfinder_collection', None) is None:
+        request._elfinder_collection = FileCollection.objects.get(pk=coll_id)
+    return request._elfinder_collection
+
+
+def get_request_digest(request, coll_id):
+    """ Returns a digest identifying the response to a read-only connector
+        command, or None if the request is for any other command.
+
+        The response to these commands only depends on the parameters read
+        by the connector and the contents of the FileCollection, so the
+        digest is built from those parameters and the collection's version.
+        Other parameters, such as the CSRF token or the '_' cache buster the
+        elFinder client adds to GET requests, differ between otherwise
+        identical requests and are ignored. The digest is used for ETags and
+        as the key for cached responses.
+    """
+    if request.method == 'POST':
+        data = request.POST
+    else:
+        data = request.GET
+    if data.get('cmd') not in READ_COMMANDS:
+        return None
+
+    collection = get_collection(request, coll_id)
+    allowed_params = ElFinderConnector().get_allowed_http_params()
+    params = sorted((key, values) for key, values in data.lists()
+                    if key in allowed_params)
+    return hashlib.md5('%s:%s:%r' % (collection.id, collection.version,
+                                     params)).hexdigest()
+
+
 def connector_view(request, coll_id):
     """ Handles requests for the elFinder connector.
+
+        Responses to read-only commands are cached for CACHE_TIMEOUT seconds.
+        Any change to the collection changes its version, and so the cache
+        key, so cached responses are never stale.
+
+        Successful responses to GET requests for read-only commands have the
+        request digest as their ETag. Error responses do not, so clients
+        do not keep revalidating errors which may have been transient.
     """
+    digest = get_request_digest(request, coll_id)
+    etag = None
+    if digest is not None:
+        if request.method == 'GET':
+            etag = quote_etag(digest)
+            # An ETag is only ever sent with a successful response, which
+            # has not changed if the digest is the same
+            if digest in parse_etags(request.META.get('HTTP_IF_NONE_MATCH',
+                                                      '')):
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+                return response
+        cache_key = 'elfinder:connector:%s' % digest
+        content = cache.get(cache_key)
+        if content is not None:
+            response = HttpResponse(content, mimetype='application/json')
+            if etag is not None:
+                response['ETag'] = etag
+            return response
 
-    model_volume = ModelVolumeDriver(coll_id)
+    model_volume = ModelVolumeDriver(coll_id,
+                                     collection=get_collection(request,
+                                                               coll_id))
 
     finder = ElFinderConnector([model_volume])
-    finder.run(request)
+    # Write commands can save or delete many objects, which only need to
+    # change the collection's version once
+    with defer_version_updates():
+        finder.run(request)
 
     # Some commands (e.g. read file) will return a Django View - if it
     # is set, return it directly instead of building a response
     if finder.return_view:
         return finder.return_view
 
-    response = HttpResponse(mimetype=finder.httpHeader['Content-type'])
-    response.status_code = finder.httpStatusCode
     if finder.httpHeader['Content-type'] == 'application/json':
-        response.content = json.dumps(finder.httpResponse)
+        content = json.dumps(finder.httpResponse)
+        # Errors are not cached or given an ETag, in case they were caused
+        # by a temporary problem (e.g. the database being unavailable).
+        if 'error' in finder.httpResponse:
+            etag = None
+        elif digest is not None:
+            cache.set(cache_key, content, CACHE_TIMEOUT)
     else:
-        response.content = finder.httpResponse
+        content = finder.httpResponse
 
+    response = HttpResponse(content,
+                            mimetype=finder.httpHeader['Content-type'])
+    response.status_code = finder.httpStatusCode
+    if etag is not None:
+        response['ETag'] = etag
     return response
 
 
@@ -1,9 +1,15 @@
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
-from django.shortcuts import render_to_response
-from django.template import RequestContext
+from django.db import connections, router, IntegrityError, transaction
+from django.db.models import Q
+from django.template.response import SimpleTemplateResponse
+from django.utils.functional import cached_property
 from elfinder.volume_drivers.base import BaseVolumeDriver
 from elfinder import models
+from mptt.models import MPTTModel
+import itertools
 import logging
+import operator
+import sys
 
 
 logger = logging.getLogger(__name__)
@@ -14,53 +20,152 @@ class ModelVolumeDriver(BaseVolumeDriver):
                  collection_model=models.FileCollection,
                  directory_model=models.Directory,
                  file_model=models.File,
+                 collection=None,
                  *args, **kwargs):
+        """ collection can be given if the FileCollection has already been
+            fetched. Otherwise only its id is looked up, and the collection
+            itself is loaded if it is needed.
+
+            directory_model and file_model only need the get_hash() and
+            get_info() methods of models.Directory and models.File. If
+            directory_model also provides info_fields and info_from_row(), and
+            file_model bulk_get_info(), trees are built from values() rows
+            instead of model instances.
+        """
 
         super(ModelVolumeDriver, self).__init__(*args, **kwargs)
         self.collection_model = collection_model
         self.directory_model = directory_model
         self.file_model = file_model
+        # Models by the type letter used in object hashes (see get_object)
+        self._type_models = {'f': file_model,
+                             'd': directory_model}
 
-        self.collection = self.collection_model.objects.get(pk=collection_id)
+        if collection is None:
+            self.collection_id = self.collection_model.objects.values_list(
+                'id', flat=True).get(pk=collection_id)
+        else:
+            self.collection_id = collection.id
+            self.collection = collection
+        # Built once, as it is the prefix of every hash
+        self._volume_id = 'fc%s' % self.collection_id
+
+        # Objects which have already been looked up, and info dicts which
+        # have already been built, keyed by hash. A driver only lives for one
+        # request, so these are cleared on writes rather than being kept in
+        # sync with the database.
+        self._objects = {}
+        self._infos = {}
+
+    @cached_property
+    def collection(self):
+        return self.collection_model.objects.get(pk=self.collection_id)
 
     def get_volume_id(self):
-        return 'fc%s' % self.collection.id
+        return self._volume_id
 
     def get_info(self, hash):
-        return self.get_object(hash).get_info()
+        if hash not in self._infos:
+            self._infos[hash] = self.get_object(hash).get_info(
+                self.get_volume_id())
+        return self._infos[hash]
 
     def get_tree(self, target, ancestors=False, siblings=False):
         """ Returns a list of dicts describing children/ancestors/siblings of
             the target directory.
 
             Siblings of the root node are always excluded, as they refer to
-            root directories of other file collections.
+            root directories of other file collections. Each directory is
+            only included once.
+
+            Where the models provide bulk_get_info()/info_from_row(), the
+            info dicts are built from values() rows, so no model instances are
+            created (see _tree_rows()).
         """
         dir = self.get_object(target)
-        tree = []
-
-        # Add children to the tree first
-        for item in dir.get_children():
-            tree.append(item.get_info())
-        for item in dir.files.all():
-            tree.append(item.get_info())
+        volume_id = self.get_volume_id()
+        directory_model = self.directory_model
+
+        # All of the directories needed are in the target's tree, so they are
+        # fetched in one query and grouped by parent, rather than calling
+        # get_children() and get_siblings() (for each ancestor). They are the
+        # children of the target, unless it is a leaf node, plus if required
+        # the ancestors, which are the nodes containing the target, and their
+        # siblings, which are the nodes whose parent contains the target. The
+        # ancestors include the target itself, so its siblings only need to
+        # be fetched separately if ancestors are not required.
+        filters = []
+        if not dir.is_leaf_node():
+            # Not Q(parent=...), which would turn the join used by the
+            # ancestors' siblings into an inner join, excluding the root
+            filters.append(Q(lft__gt=dir.lft, rght__lt=dir.rght,
+                             level=dir.level + 1))
+        if ancestors:
+            filters.append(Q(lft__lte=dir.lft, rght__gte=dir.rght))
+            filters.append(Q(parent__lft__lt=dir.lft,
+                             parent__rght__gt=dir.rght))
+        elif siblings and dir.parent_id is not None:
+            filters.append(Q(parent=dir.parent_id))
+
+        ancestor_list = []
+        children_by_parent = {}
+        if filters:
+            nodes = directory_model.objects.filter(reduce(operator.or_,
+                                                          filters),
+                                                   tree_id=dir.tree_id)
+            for row in self._tree_rows(nodes.order_by('lft'), volume_id):
+                if row['lft'] <= dir.lft and row['rght'] >= dir.rght:
+                    ancestor_list.append(row)
+                if row['parent_id'] is not None:
+                    children_by_parent.setdefault(row['parent_id'],
+                                                  []).append(row)
+
+        # Add children first
+        tree = [row['info'] for row in children_by_parent.get(dir.id, [])]
+        files = dir.files.all()
+        if hasattr(self.file_model, 'bulk_get_info'):
+            tree.extend(self.file_model.bulk_get_info(files, volume_id))
+        else:
+            tree.extend(file.get_info(volume_id) for file in files)
 
-        # Add ancestors next, if required
+        # Add ancestors next, if required, each followed by its siblings
         if ancestors:
-            for item in dir.get_ancestors(include_self=True):
-                tree.append(item.get_info())
-                for ancestor_sibling in item.get_siblings():
-                    if ancestor_sibling.parent:
-                        tree.append(ancestor_sibling.get_info())
+            for row in ancestor_list:
+                tree.append(row['info'])
+                for ancestor_sibling in children_by_parent.get(
+                        row['parent_id'], []):
+                    if ancestor_sibling['id'] != row['id']:
+                        tree.append(ancestor_sibling['info'])
 
         # Finally add siblings, if required
-        if siblings:
-            for item in dir.get_siblings():
-                if item.parent:
-                    tree.append(item.get_info())
+        elif siblings:
+            for row in children_by_parent.get(dir.parent_id, []):
+                if row['id'] != dir.id:
+                    tree.append(row['info'])
 
         return tree
 
+    def _tree_rows(self, nodes, volume_id):
+        """ Returns a dict for each directory in the nodes queryset, holding
+            its id, parent_id, lft and rght values and its info dict under
+            'info'.
+
+            Directory models with info_fields and info_from_row() are read
+            with a values() query. Other models fall back to instances and
+            get_info().
+        """
+        directory_model = self.directory_model
+        if hasattr(directory_model, 'info_from_row'):
+            rows = list(nodes.values(*directory_model.info_fields))
+            for row in rows:
+                row['info'] = directory_model.info_from_row(row, volume_id)
+            return rows
+        return [{'id': node.id,
+                 'parent_id': node.parent_id,
+                 'lft': node.lft,
+                 'rght': node.rght,
+                 'info': node.get_info(volume_id)} for node in nodes]
+
     def get_object(self, hash):
         """ Returns the object specified by the given hash.
 
@@ -78,33 +183,58 @@ class ModelVolumeDriver(BaseVolumeDriver):
 
             If the target does not belong to the current tree, return the root
             of the current tree instead.
+
+            Objects are cached by hash, so repeated lookups of the same target
+            during one request only hit the database once. The root directory
+            is requested with '' and is kept in root, and is also cached under
+            its own hash.
         """
         if hash == '':
             # No target has been specified so return the root directory.
-            return self.directory_model.objects.get(parent=None,
-                                                    collection=self.collection)
-
-        try:
-            volume_id, object_hash = hash.split('_')
-        except ValueError:
-            raise Exception('Invalid target hash: %s' % hash)
-
-        try:
-            object_id = int(object_hash[1:])
-        except ValueError:
-            raise Exception('Invalid target hash: %s' % object_hash)
-
+            return self.root
+        if hash not in self._objects:
+            self._objects[hash] = self._fetch_object(hash)
+        return self._objects[hash]
+
+    @cached_property
+    def root(self):
+        """ The root Directory of the collection, see get_object. """
+        root = self.directory_model.objects.select_related('collection').get(
+            parent=None, collection=self.collection_id)
+        self._objects[root.get_hash(self.get_volume_id())] = root
+        return root
+
+    def _clear_cache(self):
+        """ Forgets the objects and info dicts cached by get_object() and
+            get_info(). Called after every write.
+        """
+        self._objects.clear()
+        self._infos.clear()
+        # Writes can change the root's lft/rght values
+        self.__dict__.pop('root', None)
+
+    def _resolve(self, hash):
+        """ Returns the model and id of the object specified by the given
+            (non-empty) hash, without fetching it. See get_object.
+        """
+        volume_id, sep, object_hash = hash.partition('_')
         # Figure which type of object is being requested
-        if object_hash[0] == 'f':
-            model = self.file_model
-        elif object_hash[0] == 'd':
-            model = self.directory_model
-        else:
-            raise Exception('Invalid target hash: %s' % object_hash)
+        model = self._type_models.get(object_hash[:1])
+        object_id = object_hash[1:]
+        # isdigit() rather than catching ValueError from int(), which would
+        # also accept e.g. ' 1' or '-1'
+        if not sep or model is None or not object_id.isdigit():
+            raise Exception('Invalid target hash: %s' % hash)
+        return model, int(object_id)
 
+    def _fetch_object(self, hash):
+        """ Fetches the object specified by the given (non-empty) hash from
+            the database. Used by get_object.
+        """
+        model, object_id = self._resolve(hash)
         try:
-            object = model.objects.get(pk=object_id,
-                                       collection=self.collection.id)
+            object = model.objects.select_related('collection').get(
+                pk=object_id, collection=self.collection_id)
         except ObjectDoesNotExist:
             raise Exception('Could not open target')
 
@@ -118,21 +248,64 @@ class ModelVolumeDriver(BaseVolumeDriver):
 
         new_obj = model(name=name,
                         parent=parent,
-                        collection=self.collection)
+                        collection_id=self.collection_id)
+        self._save_unique(new_obj)
+        self._clear_cache()
+        return new_obj.get_info(self.get_volume_id())
+
+    def _save_unique(self, obj):
+        """ Saves a File or Directory, reporting a clash with the name of
+            another object in the same parent as an error.
+
+            Where savepoints are available, rather than checking for a clash
+            before saving (an extra query), the unique constraint is left to
+            the database, and the changes are rolled back if the save fails.
+            MPTT updates the tree before inserting a Directory, and without
+            savepoints that update can not always be rolled back, so new
+            Directories are checked before saving on those databases.
+
+            Any other IntegrityError is re-raised.
+        """
+        # The savepoint must be on the database the object is saved to
+        using = router.db_for_write(type(obj), instance=obj)
+        if (not connections[using].features.uses_savepoints and
+                obj.pk is None and isinstance(obj, MPTTModel)):
+            self._check_unique(obj)
+            obj.save(using=using)
+            return
+
+        sid = transaction.savepoint(using=using)
+        try:
+            obj.save(using=using)
+        except IntegrityError:
+            exc_info = sys.exc_info()
+            transaction.savepoint_rollback(sid, using=using)
+            # For backends which do not support savepoints
+            transaction.rollback_unless_managed(using=using)
+            self._check_unique(obj)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        transaction.savepoint_commit(sid, using=using)
+
+    def _check_unique(self, obj):
+        """ Raises an Exception if obj has the same name as another object in
+            its parent.
+        """
         try:
-            new_obj.validate_unique()
+            obj.validate_unique()
         except ValidationError, e:
             logger.exception(e)
             raise Exception("\n".join(e.messages))
 
-        new_obj.save()
-        return new_obj.get_info()
-
     def read_file_view(self, request, hash):
+        """ Renders the file with read_file.html. The template only needs the
+            file, so it is rendered with a plain Context rather than a
+            RequestContext, which would run every context processor.
+
+            The template is loaded for each request, unless Django's cached
+            template loader is enabled (see README.rst).
+        """
         file = self.get_object(hash)
-        return render_to_response('read_file.html',
-                                  {'file': file},
-                                  RequestContext(request))
+        return SimpleTemplateResponse('read_file.html', {'file': file})
 
     def mkdir(self, name, parent):
         """ Creates a new directory. """
@@ -143,57 +316,77 @@ class ModelVolumeDriver(BaseVolumeDriver):
         return self._create_object(name, parent, self.file_model)
 
     def rename(self, name, target):
-        """ Renames a file or directory. """
+        """ Renames a file or directory.
+
+            The object is saved rather than updated with a queryset, so any
+            custom save() logic and the post_save signal (which increments
+            the collection's version) still run.
+        """
         object = self.get_object(target)
         object.name = name
-        object.save()
-        return {'added': [object.get_info()],
+        self._save_unique(object)
+        self._clear_cache()
+        return {'added': [object.get_info(self.get_volume_id())],
                 'removed': [target]}
 
     def list(self, target):
-        """ Returns a list of files/directories in the target directory. """
-        list = []
-        for object in self.get_tree(target):
-            list.append(object['name'])
-        return list
+        """ Returns a list of files/directories in the target directory.
+
+            Only the names are needed, so they are fetched directly rather
+            than building info dicts with get_tree().
+        """
+        dir = self.get_object(target)
+        dirs = dir.dirs.order_by('lft').values_list('name', flat=True)
+        files = dir.files.values_list('name', flat=True)
+        return list(itertools.chain(dirs, files))
 
     def paste(self, targets, source, dest, cut):
         """ Moves/copies target files/directories from source to dest. """
         source_dir = self.get_object(source)
         dest_dir = self.get_object(dest)
+        volume_id = self.get_volume_id()
+        names = set(self.get_object(target).name for target in targets)
         added = []
         removed = []
-        for target in targets:
-            object = self.get_object(target)
-            object.parent = dest_dir
-            if not cut:
-                # This is a copy so the original object should not be changed.
-                # Setting the id to None causes Django to insert a new model
-                # instead of updating the existing one.
-                object.id = None
-
-            # If an object with the same name already exists in the target
-            # directory, it should be deleted. This needs to be done for
-            # both Files and Directories. Using filter() and iterating
-            # over the results is a bit cleaner than using get() and checking
-            # if an object was returned, even though most of the time both
-            # querysets will be empty.
-            dirs = self.directory_model.objects.filter(name=object.name,
-                                                   parent=object.parent)
-            files = self.file_model.objects.filter(name=object.name,
-                                                  parent=object.parent)
-            for dir in dirs:
-                removed.append(dir.get_hash())
-                dir.delete()
-            for file in files:
-                removed.append(file.get_hash())
-                file.delete()
-
-            object.save()
-            added.append(object.get_info())
-            if cut:
-                removed.append(object.get_info()['hash'])
 
+        # If an object with the same name already exists in the target
+        # directory, it should be deleted. This needs to be done for
+        # both Files and Directories. Only the clashing objects are fetched,
+        # with one query for each model, and the database compares the
+        # names. They are deleted before anything is pasted. MPTT uses the
+        # lft/rght of a Directory to close the gap left by deleting it, and
+        # these directories are siblings, so they are deleted from the
+        # rightmost one to leave the values of the others correct.
+        clashes = list(itertools.chain(
+            dest_dir.dirs.filter(name__in=names).order_by('-lft'),
+            dest_dir.files.filter(name__in=names)))
+
+        with models.defer_version_updates():
+            for item in clashes:
+                removed.append(item.get_hash(volume_id))
+                item.delete()
+            if clashes:
+                self._clear_cache()
+
+            for target in targets:
+                object = self.get_object(target)
+                # Fetched again after the tree has changed
+                object.parent = self.get_object(dest)
+                if not cut:
+                    # This is a copy so the original object should not be
+                    # changed. Setting the id to None causes Django to insert
+                    # a new model instead of updating the existing one.
+                    object.id = None
+
+                object.save()
+                # Moving a Directory changes the MPTT values of others
+                if isinstance(object, self.directory_model):
+                    self._clear_cache()
+                added.append(object.get_info(volume_id))
+                if cut:
+                    removed.append(object.get_hash(volume_id))
+
+        self._clear_cache()
         return {'added': added,
                 'removed': removed}
 
@@ -201,6 +394,7 @@ class ModelVolumeDriver(BaseVolumeDriver):
         """ Delete a File or Directory object. """
         object = self.get_object(target)
         object.delete()
+        self._clear_cache()
         return target
 
     def upload(self, files, parent):
@@ -212,17 +406,14 @@ class ModelVolumeDriver(BaseVolumeDriver):
         """
         added = []
         parent = self.get_object(parent)
-        for upload in files.getlist('upload[]'):
-            new_file = self.file_model(name=upload.name,
-                                       parent=parent,
-                                       collection=self.collection,
-                                       content=upload.read())
-            try:
-                new_file.validate_unique()
-            except ValidationError, e:
-                logger.exception(e)
-                raise Exception("\n".join(e.messages))
-
-            new_file.save()
-            added.append(new_file.get_info())
+        volume_id = self.get_volume_id()
+        with models.defer_version_updates():
+            for upload in files.getlist('upload[]'):
+                new_file = self.file_model(name=upload.name,
+                                           parent=parent,
+                                           collection_id=self.collection_id,
+                                           content=upload.read())
+                self._save_unique(new_file)
+                self._clear_cache()
+                added.append(new_file.get_info(volume_id))
         return {'added': added}
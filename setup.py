@@ -9,6 +9,6 @@ setup(name='django-elfinder',
       author_email='mike@fadedink.co.uk',
       url='https://github.com/mikery/django-elfinder/',
       download_url='https://github.com/mikery/django-elfinder/tarball/v0.2',
-      packages=['elfinder', 'elfinder.volume_drivers'],
-      requires=['django (>=1.3)', 'mptt (>=0.5.2)'],
+      packages=['elfinder', 'elfinder.migrations', 'elfinder.volume_drivers'],
+      requires=['django (>=1.4)', 'mptt (>=0.5.2)'],
       )